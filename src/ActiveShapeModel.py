@@ -1,15 +1,22 @@
 __author__ = 'Sebastijan'
 
-import copy
-import types
-import math
-
 import numpy as np
-from sklearn.decomposition import PCA
+from scipy.linalg import solve_triangular
+from scipy.spatial.distance import pdist, squareform
 
-import utils
 import DataManipulations
 
+try:
+    #compiled accelerator for the Procrustes iteration, built with setup_gpa.py
+    import gpa
+except ImportError:
+    gpa = None
+
+try:
+    from joblib import Parallel, delayed
+except ImportError:
+    Parallel = None
+
 
 class ReferentModel():
 
@@ -19,20 +26,33 @@ class ReferentModel():
 
             params:
                 points : matrix with landmark points, each row represents one point [y_1, x_1,.., y_n, x_n] (OpenCV-style mapping)
+
+            Notes:
+                -- points are stored as a contiguous (num_images, num_landmarks, 2) tensor, each landmark as (y, x)
         """
-        self.points = points
+        self.points = np.array(points, dtype=np.float64).reshape((len(points), -1, 2))
         self.mean_shape = None
+        self.scale_factors = None
+        self._mean_cache = None
 
     def mean_model(self):
         """
             Method calculates mean model from self.points
+            -- the result is cached and invalidated whenever self.points are mutated
+
+            returns:
+                mean model as a vector [y_1, x_1, ..., y_n, x_n]
         """
+        if self._mean_cache is None:
+            self._mean_cache = np.mean(self.points.reshape(len(self.points), -1), axis=0)
+        return self._mean_cache
 
-        #if type(self.points) is type([]):
-        if isinstance(self.points, types.ListType):
-            coll = self._convert_collection_to_matrix()
-            return np.mean(coll, axis=0)
-        return np.mean(self.points, axis=0)
+    @property
+    def mean_shape_vector(self):
+        """
+            Mean model as a vector [y_1, x_1, ..., y_n, x_n], served from the cache when valid
+        """
+        return self.mean_model()
 
     def _calculate_distances_to_points(self):
         """
@@ -41,15 +61,8 @@ class ReferentModel():
             returns:
                 distance matrix of dimensions (num_images, num_landmarks)
         """
-        distances = np.zeros((len(self.points), len(self.points[0]) / 2))
-        collector = DataManipulations.DataCollector(None)
-
-        for img in range(len(self.points)):
-            collector.read_vector(self.points[img, :])
-            points = collector.as_matrix()
-
-            for ref_point_ind in range(len(points)):
-                distances[img, ref_point_ind] = sum([utils.euclidean_distance(points[ref_point_ind, :], x) for x in points])
+        #pdist computes only the upper triangle of the symmetric pairwise distances, in C
+        distances = np.array([squareform(pdist(shape)).sum(axis=1) for shape in self.points])
 
         return distances
 
@@ -62,8 +75,10 @@ class ReferentModel():
                 weights : (1, num_points) array of weights, weight[i] corresponds to landmark point i
         """
         distances = self._calculate_distances_to_points()
-        weights = np.std(distances, axis=0, dtype=np.float64)
-        weights = np.array([1. / x for x in weights])
+        deviations = np.std(distances, axis=0, dtype=np.float64)
+
+        #eps guard keeps points with zero deviation from dividing by zero
+        weights = np.reciprocal(np.maximum(deviations, np.finfo(np.float64).eps))
 
         #normalize weights
         if norm == "normalize":
@@ -75,81 +90,62 @@ class ReferentModel():
 
         return weights
 
-    def _convert_matrix_to_collection(self):
-        """
-            Method converts the points given in matrix format to a list of DataCollector objects (easier to manipulate )
-        """
-
-        collection = []
-        for ind in range(len(self.points)):
-            tmp = DataManipulations.DataCollector(None)
-            tmp.read_vector(self.points[ind, :])
-
-            collection.append(tmp)
-
-        self.points = collection
-
-    def _convert_collection_to_matrix(self):
-        """
-            Method converts the points given as DataCollector objects to a matrix form
-        """
-
-        collection = []
-        for item in self.points:
-            collection.append(item.as_vector())
-
-        return np.array(collection)
-
     def align(self):
         """
             Method implements the alignment of landmarks based on Generalized Procrustes analysis
 
             Notes:
                 -- weighted mean is calculated when needed, not just arithmetic mean
+                -- all operations are batched over the (num_images, num_landmarks, 2) tensor
         """
         #weights = self._calculate_weights()
-        self._convert_matrix_to_collection()
-
-        #translating points to the origin to avoid need for translation
-        for item in self.points:
-            item.translate_to_origin()
-
-        #scaling shape to unit distance
-        for item in self.points:
-            item.scale_to_unit()
-            #print item.scale_factor
-
-        self.mean_shape = copy.copy(self.points[0])
-        old_mean_shape = DataManipulations.DataCollector(None)
-        old_mean_shape.read_points(np.zeros_like(self.mean_shape.points))
-
-        while utils.is_converged(old_mean_shape, self.mean_shape) is not True:
-            old_mean_shape.read_points(self.mean_shape.points)
-
-            #recalculate new mean
-            #self._convert_collection_to_matrix()
-            self.mean_shape.read_vector(self.mean_model())
-            #self._convert_matrix_to_collection()
-
-            #normalize a new mean shape
-            self.mean_shape.translate_to_origin()
-            self.mean_shape.scale_to_unit()
-
-            #realign each shape with new mean
-            for item in self.points:
-                angle = utils.rotation_alignment(self.mean_shape, item)
-                item.rotate(angle)
-
-                if item.check_distance() != 0.1:
-                    item.translate_to_origin()
-                    #item.scale_to_unit()
-                    #print item.check_distance()
-
-        #calculate mean scale factor
-        scale_factor = 0.
-        for item in self.points:
-            scale_factor += item.scale_factor
-        self.mean_shape.scale_factor = scale_factor / float(len(self.points))
+        points = self.points
+        self._mean_cache = None
+
+        #translating each shape to the origin to avoid need for translation
+        points -= points.mean(axis=1, keepdims=True)
+
+        #scaling each shape to unit distance
+        self.scale_factors = np.sqrt((points ** 2).sum(axis=(1, 2)) / points.shape[1])
+        points /= self.scale_factors[:, None, None]
+
+        mean_shape = np.copy(points[0])
+        old_mean_shape = np.zeros_like(mean_shape)
+        tolerance = 1e-6
+
+        if gpa is not None:
+            #the compiled extension drives the whole convergence loop in C
+            mean_shape = gpa.gpa_align(points, tolerance)
+        else:
+            while np.linalg.norm(mean_shape - old_mean_shape) > tolerance:
+                old_mean_shape = mean_shape
+
+                #recalculate and normalize a new mean shape
+                mean_shape = points.mean(axis=0)
+                mean_shape -= mean_shape.mean(axis=0)
+                mean_shape /= np.sqrt((mean_shape ** 2).sum() / len(mean_shape))
+
+                #realign each shape with new mean
+                #-- closed-form Procrustes: optimal rotation is U.V^T from the SVD of the per-shape covariance
+                covariances = np.einsum('nli,lj->nij', points, mean_shape)
+                u, _, vt = np.linalg.svd(covariances)
+
+                #fix reflections (det < 0) by flipping the singular direction of the smallest singular value
+                reflected = np.linalg.det(np.einsum('nij,njk->nik', u, vt)) < 0
+                u[reflected, :, -1] *= -1.
+                rotations = np.einsum('nij,njk->nik', u, vt)
+
+                points[:] = np.einsum('nli,nij->nlj', points, rotations)
+
+                #re-center only the shapes whose centroid actually drifted
+                centroids = points.mean(axis=1)
+                drifted = (centroids ** 2).sum(axis=1) > tolerance ** 2
+                points[drifted] -= centroids[drifted][:, None, :]
+
+        #mean shape is kept as a DataCollector, with the mean scale factor
+        self.mean_shape = DataManipulations.DataCollector(None)
+        self.mean_shape.read_points(mean_shape)
+        self.mean_shape.scale_factor = self.scale_factors.mean()
 
     def retrieve_mean_model(self):
         """
@@ -164,7 +160,7 @@ class ReferentModel():
         """
             Method returns aligned dataset in a n_shapes x n_landmarks matrix
         """
-        return self._convert_collection_to_matrix()
+        return self.points.reshape(len(self.points), -1)
 
     def rescale_and_realign(self):
         """
@@ -172,9 +168,9 @@ class ReferentModel():
                         position
         """
 
-        for item in self.points:
-            item.rescale_with_factor(self.mean_shape.scale_factor)
-            item.realign_to_absolute()
+        self.points *= self.mean_shape.scale_factor
+        self.points -= self.points.min(axis=1, keepdims=True)
+        self._mean_cache = None
 
         #realign the mean model also
         self.mean_shape.rescale()
@@ -192,11 +188,12 @@ class VarianceModel():
         """
         self.deviation = ref_model.retrieve_as_matrix()
         self.covariance = None
-        self.pca_fitter = None
+        self.components = None
+        self.eigenvalues = None
+        self.variance_ratios = None
         self.mean_model = ref_model.retrieve_mean_model()
 
-        for ind in range(len(self.deviation)):
-            self.deviation[ind, :] = self.deviation[ind, :] - ref_model.mean_model()
+        self.deviation = self.deviation - ref_model.mean_shape_vector[None, :]
 
     def _covariance_matrix(self):
         """
@@ -215,36 +212,41 @@ class VarianceModel():
         if self.covariance is None:
             self._covariance_matrix()
 
-        self.pca_fitter = PCA(n_components=num_comp)
-        self.pca_fitter.fit(self.deviation)
+        #eigh returns eigenvalues in ascending order -- keep the top num_comp reversed
+        eigenvals, eigenvecs = np.linalg.eigh(self.covariance)
+        self.components = eigenvecs[:, ::-1][:, :num_comp].transpose()
+        self.eigenvalues = eigenvals[::-1][:num_comp]
+        self.variance_ratios = self.eigenvalues / eigenvals.sum()
 
     def get_components(self):
         """
             Method returns the principal components calculated wth self.obtain_components
         """
 
-        if self.pca_fitter is None:
+        if self.components is None:
             raise ValueError("Components not calculated")
 
-        return self.pca_fitter.components_
+        return self.components
 
     def get_variances_explained(self):
         """
             Method returns the variance ratios of calculated components
         """
 
-        if self.pca_fitter is None:
+        if self.variance_ratios is None:
             raise ValueError("Principal components not calculated")
 
-        return self.pca_fitter.explained_variance_ratio_
+        return self.variance_ratios
 
     def get_eigenvalues(self):
         """
-            Method returns the eigenvalues of the covariance matrix
+            Method returns the eigenvalues of the covariance matrix corresponding to the calculated components
         """
 
-        eigenvals = np.linalg.eigvalsh(self.covariance)
-        return sorted(eigenvals, reverse=True)[:len(self.pca_fitter.components_)]
+        if self.eigenvalues is None:
+            raise ValueError("Principal components not calculated")
+
+        return self.eigenvalues
 
 
 class Sampler():
@@ -267,76 +269,56 @@ class Sampler():
     def _calculate_normals(self):
         """
             The method calculates the normals for each points in self.points
+            -- the normal at a point is the average of the normals of its two incident edges (closed loop assumed)
         """
-        self.normals = []
-
-        for ind in range(len(self.points.points)):
-            n1 = utils.normal(self.points.points[ind-1, :], self.points.points[ind, :])
-            n2 = utils.normal(self.points.points[ind, :], self.points.points[(ind+1) % 40, :])
+        points = self.points.points
 
-            self.normals.append((n1 + n2)/2)
+        #edge i runs from point i to point i+1; its normal is the edge rotated by 90 degrees
+        edges = np.roll(points, -1, axis=0) - points
+        perpendiculars = np.stack([-edges[:, 1], edges[:, 0]], axis=1)
 
-    def _generate_points(self, start_point, direction):
-        """
-            The method generates the points for sampling along a normal
+        self.normals = (perpendiculars + np.roll(perpendiculars, 1, axis=0)) / 2.
 
-            @params:
-                start_point : model point (2,1) array
-                direction : normal (2,1) array
-        """
-        neg_points = []
-        pos_points = []
-        starting_point = [(int(start_point[0]), int(start_point[1]))]
-        #self._calculate_normals()
-
-        ind = 1
-        while len(pos_points) < self.k:
-            new_point = (int(start_point[0] - ind * 0.02 * direction[0]), int(start_point[1] - ind * 0.02 * direction[1]))
-            if (new_point not in pos_points) and (new_point not in starting_point):
-                pos_points.append(new_point)
-            ind += 1
-
-        ind = 1
-        while len(neg_points) < self.k:
-            new_point = (int(start_point[0] + ind * 0.02 * direction[0]), int(start_point[1] + ind * 0.02 * direction[1]))
-            if (new_point not in neg_points) and (new_point not in starting_point):
-                neg_points.append(new_point)
-            ind += 1
-
-        neg_points.reverse()
-        return neg_points + starting_point + pos_points
-
-    def _sample(self, points):
+    def sample(self):
         """
-            The method samples the image from given points
+            The method performs a batch sampling for model points
+            -- all landmarks are sampled in one shot
 
-            @params:
-                points : a list of point tuples in (y_n, x_n) format
+            returns:
+                (num_points, 2k+1) array of normalized samples, ordered along each normal
         """
+        self._calculate_normals()
 
-        sample = []
+        points = self.points.points
+        normals = np.asarray(self.normals)
 
-        for item in points:
-            sample.append(self.image[item[0], item[1]])
+        #normalize each normal so one step advances exactly one pixel along its dominant axis,
+        #which guarantees 2k+1 distinct pixels per profile after the integer cast
+        steps = normals / np.abs(normals).max(axis=1, keepdims=True)
 
-        divnum = sum([math.fabs(x) for x in sample])
-        sample = [float(x)/divnum for x in sample]
+        #offsets run from +k to -k so the ordering along each normal matches [neg_k, ..., start, ..., pos_k]
+        offsets = np.arange(self.k, -self.k - 1, -1, dtype=np.float64)[None, :, None]
+        coords = (points[:, None, :] + offsets * steps[:, None, :]).astype(np.int32)
 
-        return np.array(sample)
+        #float32 is plenty for 8-bit pixel data and halves the memory traffic downstream
+        samples = self.image[coords[..., 0], coords[..., 1]].astype(np.float32)
+        samples /= np.abs(samples).sum(axis=1, keepdims=True)
 
-    def sample(self):
-        """
-            The method performs a batch sampling for model points
-        """
+        return samples
 
-        samples = []
-        self._calculate_normals()
 
-        for ind in range(len(self.points.points)):
-            points = self._generate_points(self.points.points[ind], self.normals[ind])
-            samples.append(self._sample(points))
+def _sample_one(image_path, model, k, preprocessor):
+    """
+        Helper for Profile.build -- preprocesses and samples a single image, so it can run in a worker process
 
-        return np.array(samples)
+        @params:
+            image_path : path of the image to sample from
+            model : DataCollector object with the model points for the image
+            k : number of points for sampling for each side on a normal
+            preprocessor : a function that implements the cleaning procedure for the image
+    """
+    sampler = Sampler(preprocessor(image_path), k, model)
+    return sampler.sample()
 
 
 class Profile():
@@ -357,28 +339,49 @@ class Profile():
         self.preprocessor = preprocess
         self.profiles = []
         self.covariance = []
+        self.cov_chol = None
 
     def build(self):
         """
             The method implements the profile building procedure
         """
-        tmp_samples = []   # temporary samples used for calculation of mean and covariance
-        for i in range(len(self.models[0].points)):
-            tmp_samples.append([])
+        num_images = len(self.images)
+        num_points = len(self.models[0].points)
+
+        #extracting samples for each image into one preallocated tensor
+        #-- images are independent, so they are sampled in parallel worker processes when joblib is available
+        samples = np.empty((num_images, num_points, 2 * self.k + 1), dtype=np.float32)
+        if Parallel is not None:
+            results = Parallel(n_jobs=-1)(
+                delayed(_sample_one)(self.images[ind], self.models[ind], self.k, self.preprocessor)
+                for ind in range(num_images))
+            for ind in range(num_images):
+                samples[ind] = results[ind]
+        else:
+            for ind in range(num_images):
+                samples[ind] = _sample_one(self.images[ind], self.models[ind], self.k, self.preprocessor)
 
-        #extracting samples for each image
-        for ind in range(len(self.images)):
-            sampler = Sampler(self.preprocessor(self.images[ind]), self.k, self.models[ind])
-            samples = sampler.sample()
+        #mean profile and per-landmark covariance in one pass
+        self.profiles = samples.mean(axis=0)
+        centered = samples - self.profiles
+        self.covariance = np.einsum('nlk,nlm->lkm', centered, centered) / (num_images - 1)
 
-            for i in range(len(samples)):
-                tmp_samples[i].append(samples[i, :])
+        #factor the covariances once, so Mahalanobis scoring during fitting only needs triangular solves
+        #-- the factorization is the one place where float64 is kept; the jitter absorbs float32
+        #   round-off in ill-conditioned (but full-rank) landmark covariances
+        self.cov_chol = np.linalg.cholesky(self.covariance.astype(np.float64) + 1e-8 * np.eye(2 * self.k + 1))
+
+    def mahalanobis(self, point_ind, sample):
+        """
+            The method calculates the Mahalanobis distance of a sample to the mean profile of a landmark point
+
+            @params:
+                point_ind : index of the landmark point
+                sample : (2k+1,) array of normalized samples along the normal
+        """
+        solved = solve_triangular(self.cov_chol[point_ind], sample - self.profiles[point_ind], lower=True)
 
-        #calculate mean and covariance
-        for ind in range(len(tmp_samples)):
-            tmp_array = np.array(tmp_samples[ind])
-            self.profiles.append(np.mean(tmp_array, axis=0))
-            self.covariance.append(np.cov(tmp_array, rowvar=0))
+        return solved.dot(solved)
 
 
 class ActiveShape():
@@ -80,8 +80,10 @@ def example_align_model_and_visualize_shapes():
     referent.align()
     referent.rescale_and_realign()
 
+    tmpObj = DataCollector(None)
     for shape in referent.points:
-        Plotter.render_landmarks(shape)
+        tmpObj.read_points(shape)
+        Plotter.render_landmarks(tmpObj)
 
 
 def example_calculate_principal_components():
@@ -0,0 +1,110 @@
+# cython: boundscheck=False, wraparound=False, cdivision=True
+"""
+    Optional compiled accelerator for the Generalized Procrustes iteration in
+    ReferentModel.align -- drives the whole convergence loop in C without
+    per-iteration Python dispatch.
+
+    Build in place with:
+        python setup_gpa.py build_ext --inplace
+"""
+__author__ = 'Sebastijan'
+
+import numpy as np
+
+from libc.math cimport sqrt, atan2, sin, cos
+
+
+def gpa_align(double[:, :, ::1] points, double tol):
+    """
+        Runs the Procrustes convergence loop over centered, unit-scaled shapes
+
+        params:
+            points : (num_shapes, num_points, 2) contiguous float64 tensor, aligned in place
+            tol : threshold on the Frobenius distance between consecutive mean shapes
+
+        returns:
+            mean shape as a (num_points, 2) numpy array
+    """
+    cdef Py_ssize_t num_shapes = points.shape[0]
+    cdef Py_ssize_t num_points = points.shape[1]
+    cdef Py_ssize_t n, l
+
+    mean_arr = np.copy(points[0])
+    old_arr = np.zeros((num_points, 2))
+    cdef double[:, ::1] mean = mean_arr
+    cdef double[:, ::1] old_mean = old_arr
+
+    cdef double cy, cx, norm, diff
+    cdef double numerator, denominator, angle, c, s, py, px
+
+    while True:
+        #convergence check on the Frobenius distance between consecutive means
+        diff = 0.
+        for l in range(num_points):
+            diff += (mean[l, 0] - old_mean[l, 0]) ** 2 + (mean[l, 1] - old_mean[l, 1]) ** 2
+        if sqrt(diff) <= tol:
+            break
+
+        for l in range(num_points):
+            old_mean[l, 0] = mean[l, 0]
+            old_mean[l, 1] = mean[l, 1]
+
+        #recalculate the mean shape
+        for l in range(num_points):
+            mean[l, 0] = 0.
+            mean[l, 1] = 0.
+        for n in range(num_shapes):
+            for l in range(num_points):
+                mean[l, 0] += points[n, l, 0]
+                mean[l, 1] += points[n, l, 1]
+
+        cy = 0.
+        cx = 0.
+        for l in range(num_points):
+            mean[l, 0] /= num_shapes
+            mean[l, 1] /= num_shapes
+            cy += mean[l, 0]
+            cx += mean[l, 1]
+        cy /= num_points
+        cx /= num_points
+
+        #center and scale the new mean shape to unit distance
+        norm = 0.
+        for l in range(num_points):
+            mean[l, 0] -= cy
+            mean[l, 1] -= cx
+            norm += mean[l, 0] ** 2 + mean[l, 1] ** 2
+        norm = sqrt(norm / num_points)
+        for l in range(num_points):
+            mean[l, 0] /= norm
+            mean[l, 1] /= norm
+
+        #realign each shape with the new mean -- closed-form 2-D Procrustes rotation
+        for n in range(num_shapes):
+            numerator = 0.
+            denominator = 0.
+            for l in range(num_points):
+                numerator += points[n, l, 0] * mean[l, 1] - points[n, l, 1] * mean[l, 0]
+                denominator += points[n, l, 0] * mean[l, 0] + points[n, l, 1] * mean[l, 1]
+
+            angle = atan2(numerator, denominator)
+            c = cos(angle)
+            s = sin(angle)
+
+            #rotate and re-center the shape
+            cy = 0.
+            cx = 0.
+            for l in range(num_points):
+                py = points[n, l, 0]
+                px = points[n, l, 1]
+                points[n, l, 0] = py * c - px * s
+                points[n, l, 1] = py * s + px * c
+                cy += points[n, l, 0]
+                cx += points[n, l, 1]
+            cy /= num_points
+            cx /= num_points
+            for l in range(num_points):
+                points[n, l, 0] -= cy
+                points[n, l, 1] -= cx
+
+    return mean_arr
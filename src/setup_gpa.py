@@ -0,0 +1,14 @@
+__author__ = 'Sebastijan'
+
+from distutils.core import setup
+from distutils.extension import Extension
+
+from Cython.Build import cythonize
+
+
+setup(
+    name='gpa',
+    ext_modules=cythonize([
+        Extension('gpa', ['gpa.pyx'], extra_compile_args=['-O3', '-march=native'])
+    ])
+)
@@ -4,15 +4,37 @@ import math
 
 import numpy
 
+try:
+    import numba
+except ImportError:
+    numba = None
+
+
+if numba is not None:
+    @numba.njit('f8(f8[::1],f8[::1])', fastmath=True, cache=True)
+    def _euc(point1, point2):
+        result = 0.
+        for i in range(point1.shape[0]):
+            d = point1[i] - point2[i]
+            result += d * d
+        return math.sqrt(result)
+else:
+    _euc = None
+
 
 def euclidean_distance(point1, point2):
     """
         Method calculates Euclidean distance between two points
+        -- dispatches to a numba-compiled kernel for contiguous float64 arrays when numba is available
 
         params:
             point1 = np.array(y1, x1, ...)
             point2 = np.array(y2, x2, ...)
     """
+    if _euc is not None and isinstance(point1, numpy.ndarray) and isinstance(point2, numpy.ndarray):
+        if point1.dtype == numpy.float64 and point2.dtype == numpy.float64 \
+                and point1.flags['C_CONTIGUOUS'] and point2.flags['C_CONTIGUOUS']:
+            return _euc(point1, point2)
 
     return math.sqrt(sum([(x - y) ** 2 for x, y in zip(point1, point2)]))
 
@@ -22,18 +44,14 @@ def rotation_alignment(referent_shape, current_shape):
         Method calculates rotation alignment of two shape
 
         params:
-            referent_shape : fixed shape  -- DataCollector type
-            current_shape : shape to be aligned -- DataCollector type
+            referent_shape : fixed shape  -- (num_points, 2) numpy array
+            current_shape : shape to be aligned -- (num_points, 2) numpy array
 
         returns:
             angle in radians
     """
-    numerator = 0.
-    denominator = 0.
-
-    for i in range(len(referent_shape.points)):
-        numerator += current_shape.points[i, 0] * referent_shape.points[i, 1] - current_shape.points[i, 1] * referent_shape.points[i, 0]
-        denominator += current_shape.points[i, 0] * referent_shape.points[i, 0] + current_shape.points[i, 1] * referent_shape.points[i, 1]
+    numerator = (current_shape[:, 0] * referent_shape[:, 1] - current_shape[:, 1] * referent_shape[:, 0]).sum()
+    denominator = (current_shape[:, 0] * referent_shape[:, 0] + current_shape[:, 1] * referent_shape[:, 1]).sum()
 
     return math.atan2(numerator, denominator)
 
@@ -42,8 +60,11 @@ def is_converged(old_vector, new_vector, threshold=0.0000001):
     """
         Method compares two mean shapes, one from previous iteration and second one from the current iteration
         -- converging threshold is set on the maximum change of component
+
+        params:
+            old_vector, new_vector : (num_points, 2) numpy arrays
     """
-    diff = new_vector.points - old_vector.points
+    diff = new_vector - old_vector
     #diff = numpy.power(diff, 2)
     diff = diff**2
     maximum = numpy.max(diff)